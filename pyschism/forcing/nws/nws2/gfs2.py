@@ -1,14 +1,26 @@
+from bisect import bisect_right
+from collections import deque
+from contextlib import ExitStack, closing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from functools import lru_cache
 import logging
 import pathlib
 import tempfile
 from time import time
+from itertools import chain, islice
 import glob
+import hashlib
 import multiprocessing as mp
+import os
+import struct
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore import UNSIGNED
 from botocore.config import Config
+import cfgrib
+from netCDF4 import Dataset
 import numpy as np
 import xarray as xr
 import pandas as pd
@@ -17,6 +29,185 @@ from pyschism.dates import nearest_cycle
 
 logger = logging.getLogger(__name__)
 
+MB = 1024 ** 2
+
+#only raw values and lon/lat are read, skip CF decoding and unused coordinates
+CFGRIB_KWARGS = dict(
+    decode_cf=False,
+    decode_times=False,
+    decode_coords=False,
+    drop_variables=('step', 'valid_time', 'heightAboveGround', 'surface',
+                    'meanSea', 'time'),
+)
+
+#sflux variable: [cfgrib short name, GRIB paramId, wgrib2 inventory (.idx)
+#variable and level, netCDF attributes], in the order they are written to
+#the output file
+SFLUX_VARS = {
+    'stmp': ['t2m', 167, ('TMP', '2 m above ground'), {
+        'units': 'K',
+        'long_name': '2m_above_ground/Temperature',
+    }],
+    'spfh': ['sh2', 174096, ('SPFH', '2 m above ground'), {
+        'units': 'kg kg-1',
+        'long_name': '2m_above_ground/Specific Humidity',
+        'standard_name':'specific_humidity'
+    }],
+    'uwind': ['u10', 165, ('UGRD', '10 m above ground'), {
+        'units': 'm/s',
+        'long_name': '10m_above_ground/UGRD',
+        'standard_name':'eastward_wind'
+    }],
+    'vwind': ['v10', 166, ('VGRD', '10 m above ground'), {
+        'units': 'm/s',
+        'long_name': '10m_above_ground/VGRD',
+        'standard_name':'northward_wind'
+    }],
+    'prmsl': ['prmsl', 260074, ('PRMSL', 'mean sea level'), {
+        'units': 'Pa',
+        'long_name': 'Pressure reduced to MSL',
+        'standard_name': 'air_pressure_at_sea_level'
+    }],
+    'prate': ['prate', 3059, ('PRATE', 'surface'), {
+        'units': 'kg m-2 s-1',
+        'long_name': 'Precipitation rate'
+    }],
+    'dlwrf': ['dlwrf', 260097, ('DLWRF', 'surface'), {
+        'units': 'W m-2',
+        'long_name': 'Downward short-wave radiation flux'
+    }],
+    'dswrf': ['dswrf', 260087, ('DSWRF', 'surface'), {
+        'units': 'W m-2',
+        'long_name': 'Downward long-wave radiation flux'
+    }],
+}
+
+SFLUX_PARAM_IDS = [param_id for _, param_id, _, _ in SFLUX_VARS.values()]
+
+#the messages to download when only the sflux variables are fetched
+IDX_FIELDS = {idx_field for _, _, idx_field, _ in SFLUX_VARS.values()}
+
+
+@lru_cache(maxsize=1)
+def s3_client():
+    """
+    Anonymous S3 client shared by every inventory and download thread of a
+    process.
+    """
+    return boto3.client(
+        's3', config=Config(
+            signature_version=UNSIGNED,
+            max_pool_connections=64,
+            retries={'max_attempts': 10, 'mode': 'adaptive'},
+            tcp_keepalive=True))
+
+
+@lru_cache(maxsize=1)
+def mp_context():
+    """
+    Multiprocessing context of the GFS date workers: forkserver where it is
+    available (not on Windows), the platform default otherwise.
+    """
+    if 'forkserver' not in mp.get_all_start_methods():
+        return mp.get_context()
+    ctx = mp.get_context('forkserver')
+    #xarray, cfgrib and eccodes are imported once in the forkserver and
+    #inherited by every worker instead of being imported per worker. The
+    #preload list is process-wide and applies to any forkserver started
+    #afterwards, it is only set once because of the lru_cache.
+    ctx.set_forkserver_preload([__name__])
+    return ctx
+
+
+def _worker_init():
+    """
+    Create the S3 client once per worker process, after the fork, so all the
+    dates handled by that worker reuse it.
+    """
+    s3_client()
+
+
+def select_variable(datasets, name, param_id):
+    """
+    Return the variable `name` with GRIB paramId `param_id` from the first
+    cfgrib hypercube holding it.
+    """
+    for ds in datasets:
+        if name in ds.data_vars and ds[name].attrs.get('GRIB_paramId') == param_id:
+            return ds[name]
+    raise KeyError(f'{name} with paramId {param_id} not found in GRIB file')
+
+
+def open_sflux_datasets(grbfile):
+    """
+    Open the sflux messages of `grbfile` as a list of cfgrib hypercubes.
+    """
+    #cfgrib compares the file path pickled in the on-disk index with the str
+    #path of each per-paramId re-open, a pathlib.Path never matches and makes
+    #every re-open rescan the whole file
+    return cfgrib.open_datasets(
+        str(grbfile),
+        backend_kwargs={'filter_by_keys': {'paramId': SFLUX_PARAM_IDS}},
+        **CFGRIB_KWARGS)
+
+
+def grid_definition_md5(grbfile):
+    """
+    Return the md5 of the Grid Definition Section (section 3) of the first
+    GRIB2 message in `grbfile`, or None if it can't be located.
+    """
+    with open(grbfile, 'rb') as f:
+        if f.read(16)[:4] != b'GRIB':
+            return None
+        while True:
+            header = f.read(5)
+            if len(header) < 5 or header[:4] == b'7777':
+                return None
+            length, number = struct.unpack('>IB', header)
+            if number == 3:
+                return hashlib.md5(header + f.read(length - 5)).hexdigest()
+            if number > 3:
+                return None
+            f.seek(length - 5, os.SEEK_CUR)
+
+
+def bbox_indices(lon, lat, xmin, xmax, ymin, ymax):
+    """
+    Return idx_ymin, idx_ymax, idx_xmin, idx_xmax of the monotonic lon/lat
+    vectors covering the bbox with a 1 degree margin, and the slice sl_y that
+    reads those rows in ascending latitude order.
+
+    Raises ValueError if the bbox selects no rows or columns, including a
+    bbox crossing the first longitude of the grid.
+    """
+    #GFS longitudes ascend and latitudes descend
+    idx_xmin = np.searchsorted(lon, xmin-1.0, side='left')
+    idx_xmax = np.searchsorted(lon, xmax+1.0, side='right') - 1
+    if lat[0] > lat[-1]:
+        idx_ymin = np.searchsorted(-lat, -(ymax+1.0), side='left')
+        idx_ymax = np.searchsorted(-lat, -(ymin-1.0), side='right') - 1
+    else:
+        idx_ymin = np.searchsorted(lat, ymin-1.0, side='left')
+        idx_ymax = np.searchsorted(lat, ymax+1.0, side='right') - 1
+    if idx_ymin > idx_ymax or idx_xmin > idx_xmax:
+        raise ValueError(
+            f'bbox {xmin}, {xmax}, {ymin}, {ymax} selects no GFS grid points.')
+    if lat[0] > lat[-1]:
+        sl_y = slice(idx_ymax, idx_ymin-1 if idx_ymin > 0 else None, -1)
+    else:
+        sl_y = slice(idx_ymin, idx_ymax+1)
+    return idx_ymin, idx_ymax, idx_xmin, idx_xmax, sl_y
+
+
+def remove_grib2(grbfile):
+    """
+    Remove a GRIB2 file together with the .idx files cfgrib wrote for it.
+    """
+    for idxfile in glob.glob(f'{grbfile}.*.idx'):
+        os.remove(idxfile)
+    os.remove(grbfile)
+
+
 class AWSGrib2Inventory:
 
     def __init__(
@@ -25,41 +216,146 @@ class AWSGrib2Inventory:
             record = 1,
             pscr = None,
             product='atmos',
+            prefetch=8,
+            subset_messages=False,
+            rundir=None,
     ):
         """
-        This will download the GFS data.
+        This will list the GFS data, files are downloaded by iter_files().
+
+        Files are staged in a fresh temporary directory under pscr unless
+        rundir is given. A restarted run reuses the files already there if it
+        is given the same rundir, which must not be shared with another run.
         """
         self.start_date = nearest_cycle() if start_date is None else start_date
         self.record = record
         self.pscr = pscr
         self.product = product
+        self.prefetch = prefetch
+        self.rundir = rundir
+        #fetch only the messages read by gen_sflux instead of whole files
+        self.subset_messages = subset_messages
         self.forecast_cycle = self.start_date
         self.cycle=self.forecast_cycle.hour
 
+        #only the f000, f001, ... grib2 files and their .idx sidecars match,
+        #S3 lists them in key (forecast hour) order
         paginator=self.s3.get_paginator('list_objects_v2')
         pages=paginator.paginate(Bucket=self.bucket, 
                 Prefix=f'gfs.{self.forecast_cycle.strftime("%Y%m%d")}'
-                       f'/{self.cycle:02d}/{self.product}/')
+                       f'/{self.cycle:02d}/{self.product}/'
+                       f'gfs.t{self.cycle:02d}z.pgrb2.0p25.f',
+                PaginationConfig={'PageSize': 1000,
+                                  'MaxItems': 2*(self.record*24+1)})
 
         data=[]
         for page in pages:
-            for obj in page['Contents']:
+            for obj in page.get('Contents', []):
                 data.append(obj) 
 
-        file_metadata = list(sorted([
-            _['Key'] for _ in data if '0p25' in _['Key'] and 'pgrb2' in _['Key'] and not 'goessim' in _['Key'] and not 'anl' in _['Key'] and not 'idx' in _['Key']]))
+        file_metadata = [_ for _ in data if not _['Key'].endswith('.idx')]
+
+        self.objects = file_metadata[1:self.record*24+1]
+        self.keys = [obj['Key'] for obj in self.objects]
+        if len(self.keys) > 0:
+            (self.tmpdir / self.keys[0]).parent.mkdir(parents=True, exist_ok=True)
+
+    def iter_files(self):
+        """
+        Yield the downloaded files in forecast-hour order while the next
+        `prefetch` files are being downloaded in the background.
+
+        Each file can be removed once it is decoded, this replaces the former
+        `files` property which globbed the files downloaded upfront.
+        """
+        objects = iter(self.objects)
+        # create the shared client before handing it to the worker threads
+        self.s3
+        executor = ThreadPoolExecutor(max_workers=self.prefetch)
+        pending = deque()
+        try:
+            pending.extend(executor.submit(self._download, obj)
+                           for obj in islice(objects, self.prefetch))
+            while pending:
+                filename = pending.popleft().result()
+                for obj in islice(objects, 1):
+                    pending.append(executor.submit(self._download, obj))
+                yield filename
+        finally:
+            #don't wait for the in-flight downloads when the caller stops early
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _download(self, obj):
+        key = obj['Key']
+        filename = self.tmpdir / f'{key}.grib2'
+        ranges = self._message_ranges(obj) if self.subset_messages else None
+        size = obj['Size'] if ranges is None else \
+            sum(end - start + 1 for start, end in ranges)
+        #left over by an interrupted run
+        if filename.is_file() and filename.stat().st_size == size:
+            logger.info(f'file {key} already downloaded, skipping')
+            return filename
+        logger.info(f'Downloading file {key}, ')
+        try:
+            if ranges is None:
+                self.s3.download_file(self.bucket, key, str(filename),
+                                      Config=self.transfer_config)
+            else:
+                partial = filename.with_name(f'{filename.name}.part')
+                with open(partial, 'wb') as f:
+                    for start, end in ranges:
+                        response = self.s3.get_object(
+                            Bucket=self.bucket, Key=key,
+                            Range=f'bytes={start}-{end}')
+                        f.write(response['Body'].read())
+                partial.replace(filename)
+        except Exception:
+            logger.info(f'file {key} is not available')
+            raise
+        return filename
+
+    def _message_ranges(self, obj):
+        """
+        Return the merged (start, end) byte ranges of the messages listed in
+        IDX_FIELDS, read from the .idx inventory published next to each file.
+        """
+        response = self.s3.get_object(Bucket=self.bucket, Key=f"{obj['Key']}.idx")
+        entries = []
+        for line in response['Body'].read().decode().splitlines():
+            #e.g. 1:0:d=2021101300:PRMSL:mean sea level:1 hour fcst:
+            fields = line.split(':')
+            if len(fields) >= 5:
+                entries.append((int(fields[1]), fields[3], fields[4]))
+        offsets = sorted({offset for offset, _, _ in entries}) + [obj['Size']]
+        ranges = []
+        for offset, var, level in entries:
+            if (var, level) not in IDX_FIELDS:
+                continue
+            end = offsets[bisect_right(offsets, offset)] - 1
+            if ranges and offset <= ranges[-1][1] + 1:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([offset, end])
+        if len(ranges) == 0:
+            raise ValueError(f"No sflux messages listed in {obj['Key']}.idx")
+        return ranges
 
-        for key in file_metadata[1:self.record*24+1]:
-            key2 = key + '.grib2'
-            filename = pathlib.Path(self.tmpdir) / key2
-            filename.parent.mkdir(parents=True, exist_ok=True)
+    @property
+    def max_concurrency(self):
+        """Number of ranged GETs issued per file by each download."""
+        return 4
 
-            with open(filename, 'wb') as f:
-                logger.info(f'Downloading file {key}, ')
-                try:
-                    self.s3.download_fileobj(self.bucket, key, f)
-                except:
-                    logger.info(f'file {key} is not available')
+    @property
+    def transfer_config(self):
+        if not hasattr(self, "_transfer_config"):
+            self._transfer_config = TransferConfig(
+                multipart_threshold=8*MB,
+                multipart_chunksize=16*MB,
+                max_concurrency=self.max_concurrency,
+                io_chunksize=1*MB)
+        return self._transfer_config
 
     @property
     def bucket(self):
@@ -67,31 +363,35 @@ class AWSGrib2Inventory:
 
     @property
     def s3(self):
-        try:
-            return self._s3
-        except AttributeError:
-            self._s3 = boto3.client(
-                's3', config=Config(signature_version=UNSIGNED))
-            return self._s3
+        return s3_client()
 
     @property
     def tmpdir(self):
+        if self.rundir is not None:
+            return pathlib.Path(self.rundir)
         if not hasattr(self, "_tmpdir"):
             self._tmpdir = tempfile.TemporaryDirectory(dir=self.pscr)
         return pathlib.Path(self._tmpdir.name)
 
-    @property
-    def files(self):
-        grbfiles=glob.glob(f'{self.tmpdir}/gfs.{self.forecast_cycle.strftime("%Y%m%d")}/{self.cycle:02d}/{self.product}/gfs.t{self.cycle:02d}z.pgrb2.0p25.f*.grib2')
-        grbfiles.sort()
-        return grbfiles
-
 class GFS:
-    def __init__(self, start_date=None, rnday=None, pscr=None, record=1, bbox=None):
+
+    # modified_latlon results, keyed by grid definition md5 and bbox
+    _latlon_cache = {}
+
+    def __init__(self, start_date=None, rnday=None, pscr=None, record=1, bbox=None,
+                 nc_format='NETCDF4', subset_messages=False, rundir=None):
 
         start_date = nearest_cycle() if start_date is None else start_date 
         logger.info(f'start_date is {start_date}')
         self.bbox = bbox
+        #NETCDF4 output is chunked per time step and compressed,
+        #use 'NETCDF3_CLASSIC' for readers built without netCDF-4 support
+        self.nc_format = nc_format
+        #download only the GRIB messages of the sflux variables
+        self.subset_messages = subset_messages
+        #keep the GRIB2 files here until each date's output is written, so a
+        #restarted run with the same rundir only downloads the missing ones
+        self.rundir = rundir
 
         end_date = start_date + timedelta(days=rnday)
         
@@ -101,190 +401,142 @@ class GFS:
 
         npool = len(datevector) if len(datevector) < mp.cpu_count() else mp.cpu_count()
         logger.info(f'npool is {npool}')
-        pool = mp.Pool(npool)
-
-        pool.starmap(self.gen_sflux, [(date, record, pscr) for date in datevector])
-
-        pool.close()
+        with ProcessPoolExecutor(
+                max_workers=npool,
+                mp_context=mp_context(),
+                initializer=_worker_init) as executor:
+            futures = [executor.submit(self.gen_sflux, date, record, pscr)
+                       for date in datevector]
+            for future in as_completed(futures):
+                future.result()
 
     def gen_sflux(self, date, record, pscr):
 
-        inventory = AWSGrib2Inventory(date, record, pscr)
-        grbfiles = inventory.files
+        inventory = AWSGrib2Inventory(date, record, pscr,
+                                      subset_messages=self.subset_messages,
+                                      rundir=self.rundir)
+        nt = len(inventory.keys)
         cycle = date.hour
+        if nt == 0:
+            raise ValueError(
+                f'No GFS files found for {date.strftime("%Y%m%d")} cycle {cycle:02d}.')
 
         path = pathlib.Path(date.strftime("%Y%m%d"))
         path.mkdir(parents=True, exist_ok=True)
         
-        prate = []
-        dlwrf = []
-        dswrf = []
-        stmp = []
-        spfh = []
-        uwind = []
-        vwind = []
-        prmsl = []
-
-        Vars = {
-            'group1': {'sh2': ['174096', spfh], 't2m': ['167', stmp],
-            'u10': ['165', uwind], 'v10': ['166', vwind]},
-            'group2': {'prmsl': ['meanSea', prmsl]},
-            'group3': {'prate': ['surface', prate]},
-            'group4': {'dlwrf': ['surface', dlwrf], 'dswrf': ['surface', dswrf]}
-        }
-
-        #Get lon/lat
-        lon, lat, idx_ymin, idx_ymax, idx_xmin, idx_xmax = self.modified_latlon(grbfiles[0])
-
-        for ifile, file in enumerate(grbfiles):
-            logger.info(f'file {ifile} is {file}')
-
-            for key, value in Vars.items():
-                if key == 'group1':
-                    for key2, value2 in value.items():
-                        ds = xr.open_dataset(file,
-                                engine='cfgrib',
-                                backend_kwargs=dict(filter_by_keys={'paramId':int(value2[0])}))
-                        tmp = ds[key2][idx_ymin:idx_ymax+1, idx_xmin:idx_xmax+1].astype('float32')
-                        value2[1].append(tmp[::-1,:])
-                        ds.close()
-
-                elif key == 'group2':
-                    ds = xr.open_dataset(file,
-                            engine='cfgrib',
-                            backend_kwargs=dict(filter_by_keys={'typeOfLevel':'meanSea'}))
-                    for key2, value2 in value.items():
-                        tmp = ds[key2][idx_ymin:idx_ymax+1, idx_xmin:idx_xmax+1].astype('float32')
-                        value2[1].append(tmp[::-1,:])
-                    ds.close()
-
-                elif key == 'group3':
-                    ds = xr.open_dataset(file,
-                            engine='cfgrib',
-                            backend_kwargs=dict(filter_by_keys={'stepType': 'instant','typeOfLevel': 'surface'}))
-                    for key2, value2 in value.items():
-                        tmp = ds[key2][idx_ymin:idx_ymax+1, idx_xmin:idx_xmax+1].astype('float32')
-                        value2[1].append(tmp[::-1, :])
-                    ds.close()
-
-                else:
-                    ds = xr.open_dataset(file,
-                            engine='cfgrib',
-                            backend_kwargs=dict(filter_by_keys={'stepType': 'avg','typeOfLevel': 'surface'}))
-                    for key2, value2 in value.items():
-                        tmp = ds[key2][idx_ymin:idx_ymax+1, idx_xmin:idx_xmax+1].astype('float32')
-                        value2[1].append(tmp[::-1, :])
-                    ds.close()
-
-        fout = xr.Dataset({'stmp': (['time', 'ny_grid', 'nx_grid'], np.array(stmp)),
-                'spfh': (['time', 'ny_grid', 'nx_grid'], np.array(spfh)),
-                'uwind': (['time', 'ny_grid', 'nx_grid'], np.array(uwind)),
-                'vwind': (['time', 'ny_grid', 'nx_grid'], np.array(vwind)),
-                'prmsl': (['time', 'ny_grid', 'nx_grid'], np.array(prmsl)),
-                'prate': (['time', 'ny_grid', 'nx_grid'], np.array(prate)),
-                'dlwrf': (['time', 'ny_grid', 'nx_grid'], np.array(dlwrf)),
-                'dswrf': (['time', 'ny_grid', 'nx_grid'], np.array(dswrf)),
-                },
-                coords={
-                    'time': np.round(np.arange(1, len(grbfiles)+1)/24, 4).astype('float32'),
-                    'lon': (['ny_grid', 'nx_grid'], lon),
-                    'lat': (['ny_grid', 'nx_grid'], lat)
-                })
-
         bdate = date.strftime('%Y %m %d %H').split(' ')
         bdate = [int(q) for q in bdate[:4]] + [0]
 
-        fout.time.attrs = { 
-            'long_name': 'Time',
-            'standard_name': 'time',
-            'base_date': bdate,
-            'units': f"days since {date.year}-{date.month}-{date.day} {cycle:02d}:00 UTC"
-        }
-
-        fout.lat.attrs = {
-            'units': 'degrees_north',
-            'long_name': 'Latitude',
-            'standard_name': 'latitude',
-        }
-
-        fout.lon.attrs = {
-            'units': 'degrees_east',
-            'long_name': 'Longitude',
-            'standard_name': 'longitude',
-        }
-
-        fout.uwind.attrs={
-            'units': 'm/s',
-            'long_name': '10m_above_ground/UGRD',
-            'standard_name':'eastward_wind'
-        }
-
-        fout.vwind.attrs={
-            'units': 'm/s',
-            'long_name': '10m_above_ground/VGRD',
-            'standard_name':'northward_wind'
-        }
-
-        
-        fout.spfh.attrs={
-            'units': 'kg kg-1',
-            'long_name': '2m_above_ground/Specific Humidity',
-            'standard_name':'specific_humidity'
-        }
-
-        fout.prmsl.attrs = {
-            'units': 'Pa',
-            'long_name': 'Pressure reduced to MSL',
-            'standard_name': 'air_pressure_at_sea_level'
-        }
-
-        fout.stmp.attrs={
-            'units': 'K',
-            'long_name': '2m_above_ground/Temperature',
-        }
-
-        fout.prate.attrs={
-            'units': 'kg m-2 s-1',
-            'long_name': 'Precipitation rate'
-        }
-
-        fout.dlwrf.attrs = {
-            'units': 'W m-2',
-            'long_name': 'Downward short-wave radiation flux'
+        coords = {
+            'time': {
+                'long_name': 'Time',
+                'standard_name': 'time',
+                'base_date': bdate,
+                'units': f"days since {date.year}-{date.month}-{date.day} {cycle:02d}:00 UTC"
+            },
+            'lon': {
+                'units': 'degrees_east',
+                'long_name': 'Longitude',
+                'standard_name': 'longitude',
+            },
+            'lat': {
+                'units': 'degrees_north',
+                'long_name': 'Latitude',
+                'standard_name': 'latitude',
+            },
         }
 
-        fout.dswrf.attrs = {
-            'units': 'W m-2',
-            'long_name': 'Downward long-wave radiation flux'
-        }
-                         
-        fout.to_netcdf(path / f'gfs_{date.strftime("%Y%m%d")}{cycle:02d}.nc','w', 'NETCDF3_CLASSIC', unlimited_dims='time')
+        times = np.arange(1, nt+1, dtype=np.float32) * (1.0/24.0)
+
+        decoded = []
+        #the output file and the pending downloads are released even if
+        #decoding a GRIB file fails
+        with ExitStack() as stack:
+            grbfiles = stack.enter_context(closing(inventory.iter_files()))
+
+            #Get lon/lat from the first file, the grid is the same for all
+            first = next(grbfiles)
+            lon, lat, idx_ymin, idx_ymax, idx_xmin, idx_xmax, sl_y = self.modified_latlon(first)
+            ny, nx = lon.shape
+            sl_x = slice(idx_xmin, idx_xmax+1)
+
+            #each time step is written as soon as it is decoded
+            dst = stack.enter_context(Dataset(
+                path / f'gfs_{date.strftime("%Y%m%d")}{cycle:02d}.nc',
+                'w', format=self.nc_format))
+            dst.createDimension('nx_grid', nx)
+            dst.createDimension('ny_grid', ny)
+            dst.createDimension('time', None)
+
+            dst.createVariable('time', 'f4', ('time',))
+            dst.createVariable('lon', 'f4', ('ny_grid', 'nx_grid'))
+            dst.createVariable('lat', 'f4', ('ny_grid', 'nx_grid'))
+            dst['lon'][:, :] = lon
+            dst['lat'][:, :] = lat
+
+            for var, attrs in coords.items():
+                dst[var].setncatts(attrs)
+
+            compression = {}
+            if self.nc_format == 'NETCDF4':
+                compression = dict(zlib=True, complevel=1, chunksizes=(1, ny, nx))
+            for var, (_, _, _, attrs) in SFLUX_VARS.items():
+                dst.createVariable(var, 'f4', ('time', 'ny_grid', 'nx_grid'),
+                                   **compression)
+                dst[var].setncatts({**attrs, 'coordinates': 'lon lat'})
+
+            for ifile, file in enumerate(chain([first], grbfiles)):
+                logger.info(f'file {ifile} is {file}')
+
+                #index only the sflux messages, the on-disk index is reused by
+                #the per-paramId opens done inside cfgrib.open_datasets
+                with ExitStack() as opened:
+                    datasets = [opened.enter_context(ds)
+                                for ds in open_sflux_datasets(file)]
+                    for var, (name, param_id, _, _) in SFLUX_VARS.items():
+                        da = select_variable(datasets, name, param_id)
+                        tmp = da.isel(latitude=sl_y, longitude=sl_x).values
+                        dst[var][ifile, :, :] = tmp.astype(np.float32, copy=False)
+                dst['time'][ifile] = times[ifile]
+
+                #remove the grib2 file to keep pscr small, or once the output
+                #is complete when it may be reused by a restarted run
+                if inventory.rundir is None:
+                    remove_grib2(file)
+                else:
+                    decoded.append(file)
 
+        for file in decoded:
+            remove_grib2(file)
 
     def modified_latlon(self, grbfile):
         xmin, xmax, ymin, ymax = self.bbox.xmin, self.bbox.xmax, self.bbox.ymin, self.bbox.ymax
         xmin = xmin + 360 if xmin < 0 else xmin
         xmax = xmax + 360 if xmax < 0 else xmax
 
-        ds=xr.open_dataset(grbfile,
+        gds_md5 = grid_definition_md5(grbfile)
+        cache_key = (gds_md5, xmin, xmax, ymin, ymax)
+        if gds_md5 is not None and cache_key in self._latlon_cache:
+            return self._latlon_cache[cache_key]
+
+        #the on-disk index written here has the same keys as the one of
+        #open_sflux_datasets, so the first file is scanned only once
+        with xr.open_dataset(grbfile,
                 engine='cfgrib',
-                backend_kwargs=dict(filter_by_keys={'stepType': 'instant','typeOfLevel': 'surface'}))
-        lon=ds.longitude.astype('float32')
-        lat=ds.latitude.astype('float32')
-        lon_idxs=np.where((lon.values >= xmin-1.0) & (lon.values <= xmax+1.0))[0]
-        lat_idxs=np.where((lat.values >= ymin-1.0) & (lat.values <= ymax+1.0))[0]
-        idx_ymin = lat_idxs[0]
-        idx_ymax = lat_idxs[-1]
-        idx_xmin = lon_idxs[0]
-        idx_xmax = lon_idxs[-1]
-        lon2 = lon[lon_idxs]
-        lat2 = lat[lat_idxs]
-        idxs = np.where(lon2 > 180)
-        lon2[idxs] -= 360
+                backend_kwargs=dict(filter_by_keys={'stepType': 'instant','typeOfLevel': 'surface'}),
+                **CFGRIB_KWARGS) as ds:
+            lon=ds.longitude.values.astype('float32')
+            lat=ds.latitude.values.astype('float32')
+        idx_ymin, idx_ymax, idx_xmin, idx_xmax, sl_y = bbox_indices(
+            lon, lat, xmin, xmax, ymin, ymax)
+        lon2 = lon[idx_xmin:idx_xmax+1].copy()
+        lat2 = lat[sl_y]
+        lon2[lon2 > 180] -= 360
         logger.info(f'idx_ymin is {idx_ymin}, idx_ymax is {idx_ymax}, idx_xmin is {idx_xmin}, idx_xmax is {idx_xmax}')
-        #make sure lat is in ascending order
-        nx_grid, ny_grid=np.meshgrid(lon2, lat2[::-1])
+        nx_grid, ny_grid=np.meshgrid(lon2, lat2)
 
-        ds.close()
+        latlon = nx_grid, ny_grid, idx_ymin, idx_ymax, idx_xmin, idx_xmax, sl_y
+        if gds_md5 is not None:
+            self._latlon_cache[cache_key] = latlon
 
-        return nx_grid, ny_grid, idx_ymin, idx_ymax, idx_xmin, idx_xmax
+        return latlon
@@ -0,0 +1,416 @@
+#! /usr/bin/env python
+import hashlib
+import io
+import multiprocessing
+import os
+import pathlib
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import PropertyMock, patch
+
+import cfgrib
+import eccodes
+from netCDF4 import Dataset
+import numpy as np
+import pandas as pd
+
+from pyschism.forcing.nws.nws2 import gfs2
+from pyschism.forcing.nws.nws2.gfs2 import (
+    GFS, SFLUX_PARAM_IDS, SFLUX_VARS, AWSGrib2Inventory, bbox_indices,
+    grid_definition_md5, mp_context, open_sflux_datasets)
+
+
+def section(number, payload):
+    return struct.pack('>IB', 5 + len(payload), number) + payload
+
+
+def grib2_message(*sections):
+    body = b''.join(sections) + b'7777'
+    return b'GRIB' + b'\x00\x00' + bytes([0, 2]) + \
+        struct.pack('>Q', 16 + len(body)) + body
+
+
+def sample_message(param_id, values=None, **keys):
+    """GRIB2 message of the eccodes sample grid (lat 60..0, lon 0..30)."""
+    gid = eccodes.codes_grib_new_from_samples('GRIB2')
+    eccodes.codes_set(gid, 'paramId', param_id)
+    for key, value in keys.items():
+        eccodes.codes_set(gid, key, value)
+    if values is not None:
+        eccodes.codes_set_values(gid, values.ravel())
+    message = eccodes.codes_get_message(gid)
+    eccodes.codes_release(gid)
+    return message
+
+
+class MpContextTestCase(unittest.TestCase):
+
+    def setUp(self):
+        mp_context.cache_clear()
+        self.addCleanup(mp_context.cache_clear)
+
+    def test_falls_back_without_forkserver(self):
+        with patch('multiprocessing.get_all_start_methods',
+                   return_value=['spawn']), \
+                patch('multiprocessing.context.ForkServerContext.'
+                      'set_forkserver_preload') as preload:
+            self.assertEqual(mp_context().get_start_method(),
+                             multiprocessing.get_start_method())
+        preload.assert_not_called()
+
+    def test_preloads_forkserver_once(self):
+        if 'forkserver' not in multiprocessing.get_all_start_methods():
+            self.skipTest('forkserver is not available')
+        with patch('multiprocessing.context.ForkServerContext.'
+                   'set_forkserver_preload') as preload:
+            ctx = mp_context()
+            self.assertIs(mp_context(), ctx)
+        self.assertEqual(ctx.get_start_method(), 'forkserver')
+        preload.assert_called_once_with([gfs2.__name__])
+
+
+class GridDefinitionMd5TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.tmpdir = pathlib.Path(self._tmpdir.name)
+        self.gds = section(3, bytes(range(67)))
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def write(self, data):
+        grbfile = self.tmpdir / 'test.grib2'
+        grbfile.write_bytes(data)
+        return grbfile
+
+    def test_hashes_section_3(self):
+        grbfile = self.write(grib2_message(
+            section(1, b'\x01' * 16), self.gds, section(4, b'\x00' * 29)))
+        self.assertEqual(grid_definition_md5(grbfile),
+                         hashlib.md5(self.gds).hexdigest())
+
+    def test_skips_local_use_section(self):
+        grbfile = self.write(grib2_message(
+            section(1, b'\x01' * 16), section(2, b'\x02' * 10), self.gds))
+        self.assertEqual(grid_definition_md5(grbfile),
+                         hashlib.md5(self.gds).hexdigest())
+
+    def test_independent_of_reference_time(self):
+        first = grid_definition_md5(self.write(grib2_message(
+            section(1, b'\x01' * 16), self.gds)))
+        second = grid_definition_md5(self.write(grib2_message(
+            section(1, b'\x09' * 16), self.gds)))
+        self.assertEqual(first, second)
+
+    def test_not_grib(self):
+        grbfile = self.write(b'CDF\x01' + b'\x00' * 32)
+        self.assertIsNone(grid_definition_md5(grbfile))
+
+    def test_end_marker_before_section_3(self):
+        grbfile = self.write(grib2_message(section(1, b'\x01' * 16)))
+        self.assertIsNone(grid_definition_md5(grbfile))
+
+    def test_section_after_3_without_grid(self):
+        grbfile = self.write(grib2_message(
+            section(1, b'\x01' * 16), section(4, b'\x00' * 29)))
+        self.assertIsNone(grid_definition_md5(grbfile))
+
+    def test_truncated_file(self):
+        grbfile = self.write(grib2_message(section(1, b'\x01' * 16))[:19])
+        self.assertIsNone(grid_definition_md5(grbfile))
+
+
+class BboxIndicesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.lon = np.arange(0., 360., 2.5, dtype='float32')
+        self.lat = np.arange(90., -90.1, -2.5, dtype='float32')
+
+    def assertMatchesWhere(self, lon, lat, bbox):
+        xmin, xmax, ymin, ymax = bbox
+        lon_idxs = np.where((lon >= xmin-1.0) & (lon <= xmax+1.0))[0]
+        lat_idxs = np.where((lat >= ymin-1.0) & (lat <= ymax+1.0))[0]
+        idx_ymin, idx_ymax, idx_xmin, idx_xmax, sl_y = bbox_indices(
+            lon, lat, xmin, xmax, ymin, ymax)
+        self.assertEqual((idx_ymin, idx_ymax, idx_xmin, idx_xmax),
+                         (lat_idxs[0], lat_idxs[-1], lon_idxs[0], lon_idxs[-1]))
+        np.testing.assert_array_equal(lat[sl_y], np.sort(lat[lat_idxs]))
+
+    def test_descending_latitude(self):
+        for bbox in [(262.3, 290.1, 10.2, 45.7), (0., 10., -90., 0.),
+                     (350., 359., 60., 89.5), (100., 101., -2.5, 2.5)]:
+            self.assertMatchesWhere(self.lon, self.lat, bbox)
+
+    def test_ascending_latitude(self):
+        for bbox in [(262.3, 290.1, 10.2, 45.7), (0., 10., -90., 0.),
+                     (350., 359., 60., 89.5), (100., 101., -2.5, 2.5)]:
+            self.assertMatchesWhere(self.lon, self.lat[::-1].copy(), bbox)
+
+    def test_descending_latitude_from_row_0(self):
+        _, _, _, _, sl_y = bbox_indices(
+            self.lon, self.lat, 0., 10., 80., 90.)
+        self.assertIsNone(sl_y.stop)
+        self.assertEqual(self.lat[sl_y][-1], 90.)
+
+    def test_empty_selection(self):
+        lat = np.arange(10., -10.1, -1., dtype='float32')
+        for lat_ in (lat, lat[::-1].copy()):
+            #north and south of the grid
+            for ymin, ymax in [(20., 30.), (-30., -20.)]:
+                with self.assertRaises(ValueError):
+                    bbox_indices(self.lon, lat_, 0., 10., ymin, ymax)
+        #crossing 0 degrees east, after xmin=-10 is wrapped to 350
+        with self.assertRaises(ValueError):
+            bbox_indices(self.lon, self.lat, 350., 30., 0., 10.)
+
+
+class FakeS3:
+    """Serves `objects` like S3 get_object, honouring byte Range headers."""
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.requests = []
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.requests.append((Key, Range))
+        body = self.objects[Key]
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            body = body[int(start):int(end)+1]
+        return {'Body': io.BytesIO(body)}
+
+
+def idx_line(number, offset, var, level):
+    return f'{number}:{offset}:d=2021101300:{var}:{level}:1 hour fcst:'
+
+
+class MessageRangesTestCase(unittest.TestCase):
+
+    key = 'gfs.t00z.pgrb2.0p25.f001'
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.inventory = AWSGrib2Inventory.__new__(AWSGrib2Inventory)
+        self.inventory.rundir = self._tmpdir.name
+        self.inventory.subset_messages = True
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def message_ranges(self, idx, size):
+        s3 = FakeS3({f'{self.key}.idx': idx.encode()})
+        with patch.object(AWSGrib2Inventory, 's3', new_callable=PropertyMock,
+                          return_value=s3):
+            return self.inventory._message_ranges({'Key': self.key, 'Size': size})
+
+    def test_merges_and_skips(self):
+        idx = '\n'.join([
+            idx_line(1, 0, 'HGT', 'surface'),
+            idx_line(2, 100, 'TMP', '2 m above ground'),
+            idx_line(3, 250, 'SPFH', '2 m above ground'),
+            #u and v packed as sub-messages sharing one offset
+            idx_line('4.1', 300, 'UGRD', '10 m above ground'),
+            idx_line('4.2', 300, 'VGRD', '10 m above ground'),
+            idx_line(5, 420, 'APCP', 'surface'),
+            idx_line(6, 500, 'PRATE', 'surface'),
+            idx_line(7, 560, 'DLWRF', 'surface'),
+        ])
+        self.assertEqual(self.message_ranges(idx, 600),
+                         [[100, 419], [500, 599]])
+
+    def test_no_matching_message(self):
+        idx = '\n'.join([
+            idx_line(1, 0, 'HGT', 'surface'),
+            idx_line(2, 100, 'TMP', '850 mb'),
+        ])
+        with self.assertRaises(ValueError):
+            self.message_ranges(idx, 200)
+
+    def test_download_decodes_sflux_messages(self):
+        fields = [
+            (228, 'APCP', 'surface', {}),
+            (167, 'TMP', '2 m above ground', {}),
+            (174096, 'SPFH', '2 m above ground', {}),
+            (165, 'UGRD', '10 m above ground', {}),
+            (166, 'VGRD', '10 m above ground', {}),
+            (156, 'HGT', '500 mb', {'typeOfFirstFixedSurface': 100,
+                                    'level': 500}),
+            (260074, 'PRMSL', 'mean sea level', {'typeOfFirstFixedSurface': 101}),
+            (3059, 'PRATE', 'surface', {}),
+        ]
+        messages, lines, offset = [], [], 0
+        for number, (param_id, var, level, keys) in enumerate(fields, 1):
+            message = sample_message(param_id, **keys)
+            messages.append(message)
+            lines.append(idx_line(number, offset, var, level))
+            offset += len(message)
+        data = b''.join(messages)
+        s3 = FakeS3({self.key: data, f'{self.key}.idx': '\n'.join(lines).encode()})
+
+        with patch.object(AWSGrib2Inventory, 's3', new_callable=PropertyMock,
+                          return_value=s3):
+            obj = {'Key': self.key, 'Size': len(data)}
+            filename = self.inventory._download(obj)
+            self.assertEqual(filename.stat().st_size,
+                             len(data) - len(messages[0]) - len(messages[5]))
+
+            datasets = cfgrib.open_datasets(str(filename),
+                                            backend_kwargs={'indexpath': ''})
+            names = {name for ds in datasets for name in ds.data_vars}
+            for ds in datasets:
+                ds.close()
+            self.assertEqual(names, {'t2m', 'sh2', 'u10', 'v10', 'prmsl', 'prate'})
+
+            #a rerun finds the complete file and only reads the .idx again
+            s3.requests.clear()
+            self.inventory._download(obj)
+            self.assertEqual(s3.requests, [(f'{self.key}.idx', None)])
+
+
+class IterFilesTestCase(unittest.TestCase):
+
+    def test_close_does_not_wait_for_downloads(self):
+        inventory = AWSGrib2Inventory.__new__(AWSGrib2Inventory)
+        inventory.objects = [{'Key': f'f{i:03d}'} for i in range(6)]
+        inventory.prefetch = 2
+        release = threading.Event()
+        started = []
+
+        def download(obj):
+            started.append(obj['Key'])
+            if obj['Key'] != 'f000':
+                release.wait(10)
+            return obj['Key']
+
+        with patch.object(AWSGrib2Inventory, 's3', new_callable=PropertyMock), \
+                patch.object(inventory, '_download', side_effect=download):
+            files = inventory.iter_files()
+            self.assertEqual(next(files), 'f000')
+            start = time.monotonic()
+            files.close()
+            self.assertLess(time.monotonic() - start, 5)
+            release.set()
+        self.assertNotIn('f005', started)
+
+
+class OpenSfluxDatasetsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.grbfile = pathlib.Path(self._tmpdir.name) / 'gfs.grib2'
+        self.grbfile.write_bytes(b''.join(
+            [sample_message(156, typeOfFirstFixedSurface=100, level=500)] +
+            [sample_message(param_id) for param_id in SFLUX_PARAM_IDS]))
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def count_scans(self, *opens):
+        with patch.object(cfgrib.messages.FileIndex, 'from_fieldset',
+                          wraps=cfgrib.messages.FileIndex.from_fieldset) as scan:
+            for open_ in opens:
+                open_()
+        return scan.call_count
+
+    def open_sflux(self):
+        for ds in open_sflux_datasets(self.grbfile):
+            ds.close()
+
+    def test_per_param_id_opens_share_one_index(self):
+        #a pathlib.Path, as yielded by iter_files()
+        self.assertEqual(self.count_scans(self.open_sflux), 1)
+        #the index written by the first open is reused by a later one
+        self.assertEqual(self.count_scans(self.open_sflux), 0)
+
+    def test_modified_latlon_shares_the_index(self):
+        gfs = GFS.__new__(GFS)
+        gfs.bbox = SimpleNamespace(xmin=5., xmax=20., ymin=10., ymax=40.)
+        with patch.dict(GFS._latlon_cache, clear=True):
+            self.assertEqual(self.count_scans(
+                lambda: gfs.modified_latlon(self.grbfile), self.open_sflux), 1)
+
+
+class FakeInventory:
+
+    def __init__(self, files):
+        self.files = files
+        self.keys = [file.name for file in files]
+        self.rundir = None
+
+    def iter_files(self):
+        yield from self.files
+
+
+class GenSfluxTestCase(unittest.TestCase):
+
+    #eccodes names the dlwrf and dswrf paramIds differently across versions
+    sflux_vars = {var: SFLUX_VARS[var] for var in
+                  ['stmp', 'spfh', 'uwind', 'vwind', 'prmsl', 'prate']}
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.tmpdir = pathlib.Path(self._tmpdir.name)
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.addCleanup(os.chdir, cwd)
+        #the eccodes sample grid
+        self.lon = np.arange(0., 31., 2.)
+        self.lat = np.arange(60., -1., -2.)
+        self.gfs = GFS.__new__(GFS)
+        self.gfs.bbox = SimpleNamespace(xmin=5., xmax=20., ymin=10., ymax=40.)
+        self.gfs.subset_messages = False
+        self.gfs.rundir = None
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def field(self, ifile, ivar, lon, lat):
+        return 1000.*ifile + 100.*ivar + lat + lon/100.
+
+    def write_files(self, nt):
+        lon, lat = np.meshgrid(self.lon, self.lat)
+        files = []
+        for ifile in range(nt):
+            grbfile = self.tmpdir / f'gfs.t00z.pgrb2.0p25.f{ifile+1:03d}.grib2'
+            grbfile.write_bytes(b''.join(
+                sample_message(param_id, self.field(ifile, ivar, lon, lat))
+                for ivar, (_, param_id, _, _) in enumerate(self.sflux_vars.values())))
+            files.append(grbfile)
+        return files
+
+    def test_writes_sflux_file(self):
+        date = pd.Timestamp('2021-10-13 00:00')
+        for nc_format in ['NETCDF4', 'NETCDF3_CLASSIC']:
+            with self.subTest(nc_format=nc_format):
+                files = self.write_files(3)
+                self.gfs.nc_format = nc_format
+                with patch.dict(GFS._latlon_cache, clear=True), \
+                        patch.dict(gfs2.SFLUX_VARS, self.sflux_vars, clear=True), \
+                        patch.object(gfs2, 'AWSGrib2Inventory',
+                                     return_value=FakeInventory(files)):
+                    self.gfs.gen_sflux(date, 1, None)
+
+                with Dataset(self.tmpdir / '20211013' / 'gfs_2021101300.nc') as dst:
+                    self.assertEqual(dst.file_format, nc_format)
+                    np.testing.assert_allclose(
+                        dst['time'][:], np.array([1., 2., 3.]) / 24., rtol=1e-6)
+                    lon, lat = dst['lon'][:], dst['lat'][:]
+                    #lon 4..20 and lat 10..40 with the 1 degree margin
+                    np.testing.assert_array_equal(lon[0], np.arange(4., 21., 2.))
+                    np.testing.assert_array_equal(lat[:, 0], np.arange(10., 41., 2.))
+                    for ivar, var in enumerate(self.sflux_vars):
+                        self.assertEqual(dst[var].coordinates, 'lon lat')
+                        for ifile in range(3):
+                            np.testing.assert_allclose(
+                                dst[var][ifile], self.field(ifile, ivar, lon, lat),
+                                rtol=1e-6)
+                self.assertEqual(list(self.tmpdir.glob('*.grib2*')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()